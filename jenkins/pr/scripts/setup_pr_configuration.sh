@@ -48,7 +48,7 @@ cd -
 
 # Create a virtual env for the command just checked out
 SENV_VIRTUALENV_PATH=$(mktemp -d /home/scitasbuild/humagne/pr/senv.XXXXX)
-virtualenv -p $(which python) ${SENV_VIRTUALENV_PATH} --clear
+virtualenv -p $(which python3) ${SENV_VIRTUALENV_PATH} --clear
 . ${SENV_VIRTUALENV_PATH}/bin/activate
 pip install --force-reinstall -U .
 deactivate
@@ -16,28 +16,70 @@ import re
 import copy
 import click
 import datetime
-import jinja2
+import functools
+from functools import reduce
+from operator import getitem
 import yaml
 import json
 import shutil
-import git
 import sys
+import hashlib
+import zipfile
 import logging
-from collections import MutableMapping
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import MutableMapping
 import subprocess
+from subprocess import DEVNULL
 try:
-    from subprocess import DEVNULL # py3k
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
 except ImportError:
-    DEVNULL = open(os.devnull, 'wb')
+    from yaml import SafeLoader, SafeDumper
+
+_VARIANT_RE = re.compile(r'([ +~][^ %+~@]+)*([ ^%][^ ^%]+)*')
+_VERSION_RE = re.compile(r'@([^+~\^@]+)')
+_NVPTX_RE = re.compile(r'.*\+(nvptx|cuda)')
+_INSTALLED_PKG_RE = re.compile(r'[0-9a-z]* (.*?)@.*')
+_OS_VERSION_RE = re.compile(r'([a-z]+[0-9]+)(\.[0-9]+)+')
+_SPEC_VERSION_RE = re.compile(r'[@+~^][.0-9]*')
+
+# templates compiled ahead of time by the compile-templates command, only
+# used while they match the sources unless forced with the variable below
+PRECOMPILED_TEMPLATES = '/opt/senv/templates.zip'
+PRECOMPILED_TEMPLATES_FORCE = 'SENV_FORCE_PRECOMPILED_TEMPLATES'
+PRECOMPILED_TEMPLATES_CHECKSUM = 'sources.sha256'
+TEMPLATES_DIRS = ('configuration/', 'external/', 'templates/')
+# compiled templates bytecode kept between runs
+JINJA_BYTECODE_CACHE = '.jinja_cache'
 
 logger = logging.getLogger(__name__)
 
 logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
 
-class CloneProgress(git.RemoteProgress):
-    def update(self, op_code, cur_count, max_count=None, message=''):
-        if message:
-            print(message)
+def _git(*args):
+    """Run a git command and return its output"""
+    command = ['git']
+    command.extend(args)
+    logger.debug("Running command: {0}".format(' '.join(command)))
+    return subprocess.check_output(command, stdin=DEVNULL, text=True).strip()
+
+def _git_clone(url, path, branch=None, shallow=True):
+    options = []
+    # progress messages are only worth printing on a terminal
+    if not sys.stdout.isatty():
+        options.append('--quiet')
+    if branch is not None:
+        options.extend(['--branch', branch])
+    if shallow:
+        options.extend(['--depth', '1', '--single-branch'])
+    _git('clone', *(options + [url, path]))
+
+def _git_update(path, ref):
+    """Move a shallow checkout to the latest commit of ref"""
+    _git('-C', path, 'fetch', '--depth', '1', 'origin', ref)
+    if _git('-C', path, 'rev-parse', 'HEAD') != \
+       _git('-C', path, 'rev-parse', 'FETCH_HEAD'):
+        _git('-C', path, 'reset', '--hard', 'FETCH_HEAD')
 
 COMPILERS_COMPONENTS = {
     'intel': {
@@ -85,17 +127,15 @@ def _absolute_path(value, prefix=None):
     return os.path.join(prefix, value)
 
 def _filter_variant(value):
-    variant = re.compile('([ +~][^ %+~@]+)*([ ^%][^ ^%]+)*')
     if isinstance(value, str):
-        return variant.sub("", value).strip()
-    return [ variant.sub("", v).strip() for v in value ]
+        return _VARIANT_RE.sub("", value).strip()
+    return [ _VARIANT_RE.sub("", v).strip() for v in value ]
 
 def _version(value):
     filtered_value = _filter_variant(value)
     logger.debug("Trying to extract version of \'{}\' [{}]".format(
         filtered_value, value))
-    version_re = re.compile(r"@([^+~\^@]+)")
-    match = version_re.search(filtered_value)
+    match = _VERSION_RE.search(filtered_value)
     if match:
         logger.debug("Found version \'{}\' for {}".format(
             match.group(1), filtered_value))
@@ -112,38 +152,58 @@ def _cuda_variant(environment, arch=True,
                   extra_off='', extra_on='',
                   stack='stable',
                   dep=False):
-    if 'gpu' not in environment or environment['gpu'] != 'nvidia':
-        return '~cuda{}'.format(extra_off)
+    if environment.get('gpu') != 'nvidia':
+        return '~cuda' + extra_off
 
-    variant = "+cuda"
+    variant = ['+cuda']
     if arch:
-        variant = '{0} cuda_arch={1}'.format(
-            variant,
-            environment[stack]['cuda']['arch'].replace('sm_', '')
-        )
-        variant = "{0} {1}".format(variant, extra_on)
+        variant.append('cuda_arch=' +
+                       environment[stack]['cuda']['arch'].replace('sm_', ''))
+        if extra_on:
+            variant.append(extra_on)
     if dep:
-        variant = '{0} ^{1}'.format(
-            variant,
-            environment[stack]['cuda']['package'])
+        variant.append('^' + environment[stack]['cuda']['package'])
 
-    return variant
+    return ' '.join(variant)
 
 def _hip_variant(environment, arch=True,
                   extra_off='', extra_on='',
                   stack='stable',
                   dep=False):
-    if 'gpu' not in environment or environment['gpu'] != 'amd':
-        return '~hip{}'.format(extra_off)
+    if environment.get('gpu') != 'amd':
+        return '~hip' + extra_off
 
-    variant = '+hip{}'.format(extra_on)
+    variant = ['+hip' + extra_on]
     if arch:
-        variant = '{0} amd_gpu_arch={1}'.format(
-            variant,
-            environment[stack]['rocm']['arch']
-        )
+        variant.append('amd_gpu_arch=' + environment[stack]['rocm']['arch'])
 
-    return variant
+    return ' '.join(variant)
+
+@functools.lru_cache(maxsize=None)
+def _full_compiler_name(compiler, core_compiler, cuda_package=None):
+    """Complete a compiler spec with its cuda dependency and core compiler"""
+    if cuda_package is not None and _NVPTX_RE.match(compiler):
+        compiler = '{0} ^{1}'.format(compiler, cuda_package)
+
+    if '%' in compiler:
+        return compiler
+
+    if core_compiler is None:
+        raise RuntimeError(
+            'No core_compiler defined to build {0}'.format(compiler))
+
+    return '{0} %{1}'.format(compiler, core_compiler)
+
+def _write_if_changed(path, content):
+    """Write content to path unless the file already holds it"""
+    if os.path.exists(path):
+        with open(path, 'r') as fh:
+            if fh.read() == content:
+                logger.debug('{} is up to date'.format(path))
+                return False
+    with open(path, 'w') as fh:
+        fh.write(content)
+    return True
 
 def _filter_compiler_name(value):
     def _filter_name(value):
@@ -157,10 +217,123 @@ def _filter_compiler_name(value):
         return [ _filter_name(entry) for entry in value ]
     return _filter_name(value)
 
+def _is_template_source(name):
+    return name.endswith('.j2') and name.startswith(TEMPLATES_DIRS)
+
+def _templates_checksum():
+    """Checksum of the template sources and of the jinja2 compiling them"""
+    import jinja2
+
+    checksum = hashlib.sha256(jinja2.__version__.encode())
+    names = []
+    for templates_dir in TEMPLATES_DIRS:
+        for root, _, files in os.walk(templates_dir):
+            names.extend(os.path.join(root, name) for name in files)
+
+    for name in sorted(filter(_is_template_source, names)):
+        checksum.update(name.encode())
+        with open(name, 'rb') as fh:
+            checksum.update(fh.read())
+    return checksum.hexdigest()
+
+def _use_precompiled_templates():
+    if not os.path.exists(PRECOMPILED_TEMPLATES):
+        return False
+    if os.environ.get(PRECOMPILED_TEMPLATES_FORCE):
+        return True
+
+    try:
+        with zipfile.ZipFile(PRECOMPILED_TEMPLATES) as archive:
+            checksum = archive.read(PRECOMPILED_TEMPLATES_CHECKSUM).decode()
+    except (IOError, KeyError, zipfile.BadZipFile):
+        return False
+
+    if checksum != _templates_checksum():
+        logger.info('{} does not match the templates, ignoring it'.format(
+            PRECOMPILED_TEMPLATES))
+        return False
+    return True
+
+_JINJA_ENV = None
+
+def _jinja_environment():
+    """Jinja2 environment shared by all the SpackEnvs instances"""
+    global _JINJA_ENV
+    if _JINJA_ENV is not None:
+        return _JINJA_ENV
+
+    import jinja2
+
+    # Creating Jinja2 environment, preferring precompiled templates
+    loader = jinja2.FileSystemLoader('./')
+    if _use_precompiled_templates():
+        loader = jinja2.ChoiceLoader([
+            jinja2.ModuleLoader(PRECOMPILED_TEMPLATES),
+            loader])
+
+    if not os.path.isdir(JINJA_BYTECODE_CACHE):
+        os.makedirs(JINJA_BYTECODE_CACHE)
+
+    _JINJA_ENV = jinja2.Environment(
+        loader=loader,
+        bytecode_cache=jinja2.FileSystemBytecodeCache(
+            JINJA_BYTECODE_CACHE),
+        trim_blocks=True, lstrip_blocks=True,
+        extensions=[],
+        undefined=jinja2.DebugUndefined,
+        auto_reload=False,
+        cache_size=400
+    )
+
+    # Registering custom filters
+    _JINJA_ENV.filters['exists'] = os.path.exists
+    _JINJA_ENV.filters['list_if_not'] = \
+        lambda x: x if isinstance(x, list) else [x]
+    _JINJA_ENV.filters['filter_variant'] = _filter_variant
+    _JINJA_ENV.filters['absolute_path'] = _absolute_path
+    _JINJA_ENV.filters['regex_replace'] = _regex_replace
+    _JINJA_ENV.filters['filter_compiler_name'] = _filter_compiler_name
+    _JINJA_ENV.filters['version'] = _version
+    _JINJA_ENV.globals['cuda_variant'] = _cuda_variant
+    _JINJA_ENV.globals['hip_variant'] = _hip_variant
+
+    return _JINJA_ENV
+
+class Cache(object):
+    """A YAML cache file, only written back when modified"""
+    def __init__(self, type_, config):
+        self.cache_file = os.path.expanduser('~/.{0}{1}_{2}_cache.yaml'.format(
+            config['stack_release'],
+            '.{0}'.format(config['stack_version']) if 'stack_version' in config else '',
+            type_))
+
+        try:
+            with open(self.cache_file, 'r') as fh:
+                self.cache = yaml.load(fh, Loader=SafeLoader)
+        except IOError:
+            self.cache = None
+        self.dirty = False
+
+    def append(self, value):
+        self.cache.append(value)
+        self.dirty = True
+
+    def __setitem__(self, key, value):
+        self.cache[key] = value
+        self.dirty = True
+
+    # only write back the cache if it was modified
+    def save(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        with open(self.cache_file, 'w') as fh:
+            yaml.dump(self.cache, fh, Dumper=SafeDumper)
+
 class SpackEnvs(object):
     def __init__(self, configuration, prefix=None, override={}):
         self.configuration = configuration
-        self.environments = self.configuration.pop('environments')
+        self.environments = list(self.configuration['environments'])
 
         info_message='This file was created by magic at {0}'.format(
             datetime.datetime.now().strftime("%x %X"))
@@ -175,7 +348,8 @@ class SpackEnvs(object):
             self.configuration['spack_root'] = override['spack_root']
 
         for k, v in self.configuration.items():
-            self.customisation[k] = v
+            if k != 'environments':
+                self.customisation[k] = v
 
         self.prefix = prefix
         if prefix is None:
@@ -205,120 +379,131 @@ class SpackEnvs(object):
             self.spack_source_root,
             "var", "spack", "environments")
 
-        # Creating Jinja2 environment
-        self.spack_env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader('./'),
-            trim_blocks=True, lstrip_blocks=True,
-            extensions=[],
-            undefined=jinja2.DebugUndefined
-        )
-
-        # Registering custom filters
-        self.spack_env.filters['exists'] = os.path.exists
-        self.spack_env.filters['list_if_not'] = \
-            lambda x: x if isinstance(x, list) else [x]
-        self.spack_env.filters['filter_variant'] = _filter_variant
-        self.spack_env.filters['absolute_path'] = _absolute_path
-        self.spack_env.filters['regex_replace'] = _regex_replace
-        self.spack_env.filters['filter_compiler_name'] = _filter_compiler_name
-        self.spack_env.filters['compiler_component'] = self._compiler_component
-        self.spack_env.filters['full_compiler_name'] = self._compiler_name
-        self.spack_env.filters['spack_path'] = self._spack_path
-        self.spack_env.filters['version'] = _version
-        self.spack_env.globals['cuda_variant'] = _cuda_variant
-        self.spack_env.globals['hip_variant'] = _hip_variant
+        self._path_re = re.compile('.*(({0}|{1}).*)$'.format(
+            self.spack_install_root,
+            _absolute_path(self.configuration['spack_external'],
+                           prefix=self.configuration['spack_root'])))
 
+        # the Jinja2 environment is only created when templates are needed
+        self._spack_env = None
+        self._template_cache = {}
+        self._env_cust_cache = {}
+        self._default_env_cust = None
+        self._caches = {}
+        # guards the caches when environments are written in parallel
+        self._lock = threading.RLock()
+        self._python_activated_cache = {}
+        # specs spack find could not resolve, left to _spack_path
+        self._unresolved_paths = set()
+
+    @property
+    def spack_env(self):
+        if self._spack_env is None:
+            self._spack_env = self._create_spack_env()
+        return self._spack_env
+
+    def _create_spack_env(self):
+        # the filters below need this instance, keep them off the shared
+        # environment's filter dictionary
+        spack_env = _jinja_environment().overlay()
+        spack_env.filters = dict(spack_env.filters)
+        spack_env.filters['compiler_component'] = self._compiler_component
+        spack_env.filters['full_compiler_name'] = self._compiler_name
+        spack_env.filters['spack_path'] = self._spack_path
+        return spack_env
 
     def _create_jinja_environment(self, template_path=None):
         if template_path is None:
             template_path = os.path.join('templates', 'common', 'spack.yaml.j2')
-        return self.spack_env.get_template(template_path)
+        # precompiled templates are looked up by their normalized name
+        template_path = os.path.normpath(template_path)
+        if template_path not in self._template_cache:
+            self._template_cache[template_path] = \
+                self.spack_env.get_template(template_path)
+        return self._template_cache[template_path]
 
     def _dict_merge(self, d1, d2):
         '''
-        Update two dicts of dicts recursively,
+        Update d1 in place with the dicts of dicts of d2,
         if either mapping has leaves that are non-dicts,
         the second's leaf overwrites the first's.
+        Values taken from d2 are copied so d1 never aliases it.
         '''
-        for k, v in d1.items(): # in Python 2, use .iteritems()!
-            if k in d2:
-                # this next check is the only difference!
-                if all(isinstance(e, MutableMapping) for e in (v, d2[k])):
-                    d2[k] = self._dict_merge(v, d2[k])
-                # we could further check types and merge as appropriate here.
-        d3 = d1.copy()
-        d3.update(d2)
-        return d3
-
-    # get a cache for a given operation
+        stack = [(d1, d2)]
+        while stack:
+            dst, src = stack.pop()
+            for k, v in src.items():
+                if (k in dst and isinstance(dst[k], MutableMapping)
+                        and isinstance(v, MutableMapping)):
+                    stack.append((dst[k], v))
+                else:
+                    dst[k] = copy.deepcopy(v)
+        return d1
+
+    # get a cache for a given operation, loaded once per instance
     def _get_cache(self, type_):
-        class cache(object):
-            def __init__(self, type_, config):
-                
-                self.cache_file = os.path.expanduser('~/.{0}{1}_{2}_cache.yaml'.format(
-                    config['stack_release'],
-                    '.{0}'.format(config['stack_version']) if 'stack_version' in config else '',
-                    type_))
-
-                try:
-                    with open(self.cache_file, 'r') as fh:
-                        self.cache = yaml.load(fh, Loader=yaml.FullLoader)
-                except IOError:
-                    self.cache = None
-                    pass
-
-            def save(self):
-                with open(self.cache_file, 'w') as fh:
-                    yaml.dump(self.cache, fh)
-
-        return cache(type_, self.configuration)
+        if type_ in self._caches:
+            return self._caches[type_]
 
-    # get the environment dict overriding the configurations
-    # if there are environment specific ones
-    def _get_env_customisation(self, environment):
+        self._caches[type_] = Cache(type_, self.configuration)
+        return self._caches[type_]
+
+    def _check_environment(self, environment):
         if environment not in self.environments and environment is not None:
             raise RuntimeError(
                 'The environment {0} is not defined.'
                 ' Valid environments are {1}'.format(environment,
                                                      self.list_envs(all=True)))
-        customisation = copy.copy(self.customisation)
 
-        customisation["environment"]['name'] = environment
+    # get the environment dict merged with the environment specific
+    # configuration, without resolving anything through spack
+    def _get_env_shallow(self, environment):
+        # self.customisation is the base for every environment and is
+        # never modified, the environment gets its own copy
+        env = copy.deepcopy(self.customisation['environment'])
+        env['name'] = environment
         if environment is None:
-            customisation["environment"]['name'] = 'None'
+            env['name'] = 'None'
 
-        # create a dictionary for each environment
-        env = customisation['environment']
         if environment in self.configuration:
-            customisation['environment'] = self._dict_merge(
-                customisation['environment'],
-                self.configuration[environment])
+            self._dict_merge(env, self.configuration[environment])
 
         if self.override:
-            customisation['environment'] = self._dict_merge(
-                customisation['environment'],
-                self.override
-            )
+            self._dict_merge(env, self.override)
+
+        return env
+
+    # get the environment dict overriding the configurations
+    # if there are environment specific ones
+    def _get_env_customisation(self, environment):
+        self._check_environment(environment)
+
+        # callers modify the returned customisation, so hand out copies
+        with self._lock:
+            if environment not in self._env_cust_cache:
+                self._env_cust_cache[environment] = \
+                    self._build_env_customisation(environment)
+            return copy.deepcopy(self._env_cust_cache[environment])
+
+    def _build_env_customisation(self, environment):
+        customisation = dict(self.customisation)
+        customisation['environment'] = self._get_env_shallow(environment)
 
         # adds the compiler prefixes if they do not exists
         env = customisation['environment']
-        for _type in env['stack_types']:
-            if _type not in env:
-                continue
+        missing_prefixes = self._missing_compiler_prefixes(env)
 
-            for compiler in env[_type]:
-                stack = env[_type][compiler]
-                if 'compiler' not in stack or 'compiler_prefix' in stack:
-                    continue
-                
-                spec_compiler = self._compiler_name(
-                    stack, env, stack_type=_type)
+        # resolve all the prefixes in one spack call to fill the cache
+        self._spack_paths([
+            self._compiler_name(env[_type][compiler], env, stack_type=_type)
+            for _type, compiler in missing_prefixes])
 
-                spack_path = self._compiler_component(compiler, "prefix", env,
-                                                      stack_type=_type)
+        for _type, compiler in missing_prefixes:
+            spack_path = self._compiler_component(compiler, "prefix", env,
+                                                  stack_type=_type)
 
-                if spack_path is not None:
-                    env[_type][compiler]['compiler_prefix'] = spack_path
+            if spack_path is not None:
+                env[_type][compiler]['compiler_prefix'] = spack_path
 
         logger.debug(
             "Customisation for env {}: {}".format(
@@ -327,31 +512,54 @@ class SpackEnvs(object):
 
         return customisation
 
-    def _compiler_name(self, compiler_stack, environment, stack_type=None):
-        compiler_ = copy.copy(compiler_stack['compiler'])
+    # (stack type, compiler) of the stacks without a compiler prefix
+    def _missing_compiler_prefixes(self, env):
+        missing_prefixes = []
+        for _type in env['stack_types']:
+            if _type not in env:
+                continue
 
-        stack = None
-        if stack_type is not None:
-            stack = environment[stack_type]
+            for compiler in env[_type]:
+                stack = env[_type][compiler]
+                if 'compiler' not in stack or 'compiler_prefix' in stack:
+                    continue
+                missing_prefixes.append((_type, compiler))
+        return missing_prefixes
 
-        nvptx_re = re.compile('.*\+(nvptx|cuda)')
-        if stack is not None and nvptx_re.match(compiler_) and 'cuda' in stack:
-            compiler_ = '{0} ^{1}'.format(compiler_, stack['cuda']['package'])
+    # customisation of the default environment, not to be modified
+    def _get_default_customisation(self):
+        if self._default_env_cust is None:
+            self._default_env_cust = self._get_env_customisation(None)
+        return self._default_env_cust
 
-        if '%' in compiler_:
-            return compiler_
+    def _compiler_name(self, compiler_stack, environment, stack_type=None):
+        cuda_package = None
+        if stack_type is not None and 'cuda' in environment[stack_type]:
+            cuda_package = environment[stack_type]['cuda']['package']
 
-        core_compiler = environment['core_compiler']
         if 'core_compiler' in compiler_stack:
-            core_compiler = compiler_stack['core_compiler'] 
+            core_compiler = compiler_stack['core_compiler']
+        else:
+            core_compiler = environment.get('core_compiler')
 
-        return '{0} %{1}'.format(compiler_, core_compiler)
+        return _full_compiler_name(compiler_stack['compiler'],
+                                   core_compiler, cuda_package)
 
     def _run_spack(self, *args, **kwargs):
         no_wait = kwargs.pop('no_wait', False)
         environment = kwargs.pop('environment', None)
-        options = { 'stdout': subprocess.PIPE,
-                    'stderr': subprocess.PIPE }
+        options = { 'stdin': DEVNULL,
+                    'stdout': subprocess.PIPE,
+                    'stderr': subprocess.PIPE,
+                    'close_fds': True,
+                    'bufsize': 1,
+                    'text': True,
+                    # spack can print non-ascii package descriptions
+                    'encoding': 'utf-8',
+                    'errors': 'replace' }
+        if no_wait:
+            # nobody reads stderr, do not let it fill the pipe
+            options['stderr'] = DEVNULL
         if environment is not None:
             options['env'] = {
                 'SPACK_ENV': os.path.join(
@@ -366,44 +574,102 @@ class SpackEnvs(object):
             ' '.join(command), options['env'] if 'env' in options else {}))
         
         spack = subprocess.Popen(command, **options)
+        if no_wait:
+            return spack
+
         stdout, stderr = spack.communicate()
-        logger.debug("Stdout: {0}".format(stdout.decode('utf-8')))
-        logger.debug("Stderr: {0}".format(stderr.decode('utf-8')))
-        return stdout.decode('ascii').split('\n'), stderr, spack
+        logger.debug("Stdout: {0}".format(stdout))
+        logger.debug("Stderr: {0}".format(stderr))
+        return stdout.split('\n'), stderr, spack
 
     def _spack_path(self, value, environment=None):
-        logger.debug('Searching path of \'{}\''.format(value))
-        cache = self._get_cache('compilers')
-        if cache.cache is None:
-            cache.cache = {}
-
-        if value in cache.cache:
-            logger.debug("Path found in cache {}".format(cache.cache[value]))
-            return cache.cache[value]
-        
-        stdout, stderr, comm = self._run_spack(
-            'location', '--install-dir', value,
-            environment=environment)
-
-        path_re = re.compile('.*(({0}|{1}).*)$'.format(
-            self.spack_install_root,
-            _absolute_path(self.configuration['spack_external'],
-                           prefix=self.configuration['spack_root'])))
-
-        for line in stdout:
-            match = path_re.match(line)
-            if match:
-                spack_path = match.group(1)
-                logger.debug("Path found match {}".format(spack_path))
-                cache.cache[value] = spack_path
-                cache.save()
-                return spack_path
-
-        logger.info("No path found for {}".format(value))
-        return None
+        with self._lock:
+            logger.debug('Searching path of \'{}\''.format(value))
+            cache = self._get_cache('compilers')
+            if cache.cache is None:
+                cache.cache = {}
+
+            if value in cache.cache:
+                logger.debug("Path found in cache {}".format(cache.cache[value]))
+                return cache.cache[value]
+
+            spack = self._run_spack(
+                'location', '--install-dir', value,
+                environment=environment, no_wait=True)
+
+            spack_path = None
+            with spack.stdout:
+                for line in spack.stdout:
+                    match = self._path_re.match(line)
+                    if match:
+                        spack_path = match.group(1)
+                        # the path is all we need from spack
+                        spack.terminate()
+                        break
+            spack.wait()
+
+            if spack_path is None:
+                logger.info("No path found for {}".format(value))
+                return None
+
+            logger.debug("Path found match {}".format(spack_path))
+            cache[value] = spack_path
+            cache.save()
+            return spack_path
+
+    def _spack_paths(self, values, environment=None):
+        """Get the paths of several specs with a single call to spack"""
+        with self._lock:
+            cache = self._get_cache('compilers')
+            if cache.cache is None:
+                cache.cache = {}
+
+            paths = {}
+            missing = []
+            for value in values:
+                if value in cache.cache:
+                    paths[value] = cache.cache[value]
+                elif value not in missing \
+                        and value not in self._unresolved_paths:
+                    missing.append(value)
+
+            if not missing:
+                return paths
+
+            logger.debug('Searching paths of {}'.format(missing))
+            stdout, stderr, comm = self._run_spack(
+                'find', '--paths', *missing,
+                environment=environment)
+
+            found = {}
+            for line in stdout:
+                match = self._path_re.match(line)
+                if match:
+                    found.setdefault(line.split()[0], []).append(match.group(1))
+
+            # spack does not tell which query an installed spec answers, so
+            # matches are made on the name@version of the root spec and only
+            # kept when a single query and a single installed spec share it,
+            # the others are left to _spack_path
+            keys = {}
+            for value in missing:
+                key = _filter_variant(value.split('^')[0])
+                keys.setdefault(key, []).append(value)
+
+            for key, queries in keys.items():
+                candidates = found.get(key, [])
+                if len(queries) == 1 and len(candidates) == 1:
+                    value = queries[0]
+                    logger.debug("Path found match {}".format(candidates[0]))
+                    paths[value] = candidates[0]
+                    cache[value] = candidates[0]
+            self._unresolved_paths.update(
+                value for value in missing if value not in paths)
+            cache.save()
+            return paths
 
     def compilers(self, environment, stack_type=None, all=False):
-        compilers = []
+        compilers = set()
         customisation = self._get_env_customisation(environment)
         if stack_type is not None:
             stack_types = [stack_type]
@@ -411,22 +677,23 @@ class SpackEnvs(object):
             stack_types = customisation['environment']['stack_types']
         environments = [customisation['environment']]
         if all:
-            environments.append(self._get_env_customisation(None)['environment'])
+            environments.append(
+                self._get_default_customisation()['environment'])
 
         for env in environments:
             for _type in stack_types:
                 for name, stack in env[_type].items():
                     if 'compiler' in stack and name in env['compilers']:
-                        compilers.append(self._compiler_name(
+                        compilers.add(self._compiler_name(
                             stack, env, stack_type=_type))
                         if 'core_compiler' in stack:
-                            compilers.append(
+                            compilers.add(
                                 "{} %{}".format(
                                     _filter_variant(
                                         stack['core_compiler'])
                                     , env['core_compiler']))
 
-        return list(set(compilers))
+        return list(compilers)
 
     def status(self):
         if self.in_pr:
@@ -442,24 +709,44 @@ class SpackEnvs(object):
         for env_name in self.environments:
             logger.debug(
                 "Getting env custimuization for env {}".format(env_name))
-            customisation = self._get_env_customisation(env_name)
-            env = customisation['environment']
+            env = self._get_env_shallow(env_name)
             if ((cloud is None and 'cloud' not in env)
                  or (cloud is not None and ('cloud' in env and env['cloud'] == cloud))):
                 envs.append(env_name)
         return envs
 
     def write_envs(self, bootstrap=False):
+        # resolve the compilers of all the environments in one spack call
+        specs = []
         for environment in self.environments:
-            self.write_env(environment, bootstrap)
+            env = self._get_env_shallow(environment)
+            specs.extend([
+                self._compiler_name(env[_type][compiler], env,
+                                    stack_type=_type)
+                for _type, compiler in self._missing_compiler_prefixes(env)])
+        self._spack_paths(specs)
+
+        spack_env_template = self._create_jinja_environment()
+        max_workers = max(1, min(8, len(self.environments)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(
+                lambda environment: self._write_env_with_tpl(
+                    environment, spack_env_template, bootstrap),
+                self.environments))
 
     def write_env(self, environment, bootstrap=False):
+        self._write_env_with_tpl(environment,
+                                 self._create_jinja_environment(),
+                                 bootstrap)
+
+    def _write_env_with_tpl(self, environment, spack_env_template,
+                            bootstrap=False):
         spack_yaml_root = os.path.join(self.spack_environment_root,
                                        environment)
-        print('Creating evironment {0}  in {1}'.format(environment,
-                                                       spack_yaml_root))
-
-        spack_env_template = self._create_jinja_environment()
+        # environments are written from several threads, keep lines whole
+        with self._lock:
+            print('Creating evironment {0}  in {1}'.format(environment,
+                                                           spack_yaml_root))
 
         if not os.path.isdir(spack_yaml_root):
             raise RuntimeError(
@@ -469,8 +756,21 @@ class SpackEnvs(object):
 
         customisation = self._get_env_customisation(environment)
         customisation['environment']['bootstrap'] = bootstrap
-        with open(os.path.join(spack_yaml_root, 'spack.yaml'), 'w+') as f:
-            f.write(spack_env_template.render(customisation))
+        rendered = spack_env_template.render(customisation)
+        spack_yaml = os.path.realpath(
+            os.path.join(spack_yaml_root, 'spack.yaml'))
+        # write aside and swap so spack never sees a partial file
+        spack_yaml_tmp = spack_yaml + '.tmp'
+        try:
+            with open(spack_yaml_tmp, 'w',
+                      buffering=max(8192, len(rendered))) as f:
+                f.write(rendered)
+            if os.path.exists(spack_yaml):
+                shutil.copymode(spack_yaml, spack_yaml_tmp)
+            os.replace(spack_yaml_tmp, spack_yaml)
+        finally:
+            if os.path.exists(spack_yaml_tmp):
+                os.remove(spack_yaml_tmp)
 
     def spack_release(self):
         print(self.configuration['spack_release'])
@@ -484,18 +784,12 @@ class SpackEnvs(object):
 
     def spack_checkout(self):
         if not os.path.exists(self.spack_source_root):
-            git.Repo.clone_from('https://github.com/spack/spack.git',
-                                self.spack_source_root,
-                                branch=self.configuration['spack_release'],
-                                progress=CloneProgress())
+            _git_clone('https://github.com/spack/spack.git',
+                       self.spack_source_root,
+                       branch=self.configuration['spack_release'])
         else:
-            git_repo = git.Repo(self.spack_source_root)
-            local_branch = self.configuration['spack_release']
-            git_repo.remotes.origin.fetch()
-
-            commit = git_repo.commit(local_branch)
-            if commit != git_repo.head.commit:
-                git_repo.remotes.origin.pull(local_branch)
+            _git_update(self.spack_source_root,
+                        self.configuration['spack_release'])
 
 
     def spack_checkout_extra_repos(self):
@@ -510,34 +804,38 @@ class SpackEnvs(object):
                         self.configuration['stack_release'],
                         'external_repos'])
 
-            options={ 'progress': CloneProgress() }
             if os.path.exists(repo_path):
-                git_repo = git.Repo(repo_path)
-                git_repo.remotes.origin.pull(**options)
-            else:
                 if 'tag' in info:
-                    options['branch'] = info['tag']
-                git_repo = git.Repo.clone_from(
-                    info['repo'], repo_path, **options)
+                    _git_update(repo_path, info['tag'])
+                else:
+                    _git('-C', repo_path, 'pull')
+            else:
+                # in a PR all the remote branches are needed to switch
+                # to the one being tested
+                _git_clone(info['repo'], repo_path,
+                           branch=info.get('tag'),
+                           shallow=not self.in_pr)
                 if self.in_pr and 'GIT_BRANCH' in os.environ:
                     remote_branch = os.environ['GIT_BRANCH']
                     local_branch = remote_branch.replace('origin/', '')
-                    for ref in git_repo.remotes.origin.refs:
-                        if ref.name == remote_branch:
-                            print('Changing default branch fo repo ' +
-                                  '\"{}\" from {} to {}'.format(
-                                      repo,
-                                      git_repo.head.reference.name,
-                                      local_branch))
-                            new_ref = git_repo.create_head(local_branch, ref)
-                            new_ref.set_tracking_branch(ref)
-                            new_ref.checkout()
-                            break
+                    try:
+                        _git('-C', repo_path, 'rev-parse', '--verify',
+                             '--quiet', 'refs/remotes/' + remote_branch)
+                    except subprocess.CalledProcessError:
+                        continue
+                    print('Changing default branch fo repo ' +
+                          '\"{}\" from {} to {}'.format(
+                              repo,
+                              _git('-C', repo_path, 'rev-parse',
+                                   '--abbrev-ref', 'HEAD'),
+                              local_branch))
+                    _git('-C', repo_path, 'checkout', '-b', local_branch,
+                         '--track', remote_branch)
 
     def list_extra_repositories(self):
         repositories = []
         for item in self.configuration['extra_repos']:
-            repo = self.configuration['extra_repos'][item]
+            repo = dict(self.configuration['extra_repos'][item])
             repo['name'] = item
             repo['path'] = _absolute_path(
                 repo['path'],
@@ -545,30 +843,51 @@ class SpackEnvs(object):
                         self.configuration['stack_release'],
                         'external_repos'])
             repositories.append(repo)
-        print(yaml.dump(repositories))
+        print(yaml.dump(repositories, Dumper=SafeDumper))
 
     def install_spack_default_configuration(self):
-        jinja_file_re = re.compile('(.*\.ya?ml)\.j2$')
         spack_config_path = os.path.join(self.spack_source_root, 'etc', 'spack')
-        customisation = self._get_env_customisation(None)
-        for _file in os.listdir('./configuration'):
-            m = jinja_file_re.match(_file)
-            template_path = os.path.join('./configuration', _file)
-            if  m is not None:
-                spack_env_template = self._create_jinja_environment(
-                    template_path)
-                with open(os.path.join(
-                        spack_config_path, m.group(1)), 'w') as fh:
-                    fh.write(spack_env_template.render(customisation))
-            else:
-                shutil.copyfile(
-                    template_path,
-                    os.path.join(spack_config_path, _file))
+        customisation = self._get_default_customisation()
+        with os.scandir('./configuration') as entries:
+            for entry in entries:
+                _file = entry.name
+                template_path = os.path.join('./configuration', _file)
+                if _file.endswith(('.yaml.j2', '.yml.j2')):
+                    spack_env_template = self._create_jinja_environment(
+                        template_path)
+                    _write_if_changed(
+                        os.path.join(spack_config_path, _file[:-3]),
+                        spack_env_template.render(customisation))
+                else:
+                    shutil.copyfile(
+                        template_path,
+                        os.path.join(spack_config_path, _file))
+
+    def compile_templates(self, target=PRECOMPILED_TEMPLATES):
+        import jinja2
+
+        target_dir = os.path.dirname(target)
+        if target_dir and not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+
+        # always compile from the sources, never from a previous archive
+        spack_env = self.spack_env.overlay(
+            loader=jinja2.FileSystemLoader('./'))
+        target_tmp = target + '.tmp'
+        try:
+            spack_env.compile_templates(
+                target_tmp, zip='deflated', filter_func=_is_template_source)
+            with zipfile.ZipFile(target_tmp, 'a') as archive:
+                archive.writestr(PRECOMPILED_TEMPLATES_CHECKSUM,
+                                 _templates_checksum())
+            os.replace(target_tmp, target)
+        finally:
+            if os.path.exists(target_tmp):
+                os.remove(target_tmp)
 
     def intel_compilers_configuration(self, environment):
         customisation = self._get_env_customisation(environment)
         env = customisation['environment']
-        jinja_file_re = re.compile('((.*)\.cfg)\.j2$')
         for _type in env['stack_types']:
             dict_ = env[_type]
             dict_['stack_release'] = self.configuration['stack_release']
@@ -598,10 +917,11 @@ class SpackEnvs(object):
                         core_compiler_prefix
 
                 _external_path = './external/{}/config'.format(_compiler_name)
-                for _file in os.listdir(_external_path):
-                    m = jinja_file_re.match(_file)
-                    if not m:
-                        continue
+                with os.scandir(_external_path) as entries:
+                    _files = [entry.name for entry in entries
+                              if entry.name.endswith('.cfg.j2')]
+
+                for _file in _files:
                     template_path = os.path.join(
                         _external_path,
                         _file)
@@ -609,23 +929,25 @@ class SpackEnvs(object):
                         template_path)
 
                     for _path in intel_config_path:
-                        compiler_file = os.path.join(_path, m.group(2))
+                        compiler_file = os.path.join(_path, _file[:-7])
                         logger.debug('Checking if {} is a valid compiler'.format(compiler_file))
                         if not os.path.exists(compiler_file):
                             continue
 
-                        config_file = os.path.join(_path, m.group(1))
-                        with open(config_file, 'w') as fh:
-                            fh.write(spack_env_template.render(dict_))
+                        config_file = os.path.join(_path, _file[:-3])
+                        if _write_if_changed(config_file,
+                                             spack_env_template.render(dict_)):
                             logger.debug('Writing file {} with config {}'.format(config_file, dict_))
 
-    def spack_list_python(self, env, stack_type=None, installed_only=False):
-        spack_config_path = os.path.join(self.spack_source_root, 'etc', 'spack')
-        customisation = self._get_env_customisation(env)
+    # list of python packages to activate per python version, the templates
+    # only depend on the environment so they are rendered once
+    def _python_activated(self, env, customisation):
+        if env in self._python_activated_cache:
+            return self._python_activated_cache[env]
+
         template_path = os.path.join('./templates/',
                                      self.configuration['site'],
                                      self.configuration['stack_release'])
-        specs = []
         python_activated = {}
         for ver in [2, 3]:
             python_package_list = os.path.join(
@@ -638,7 +960,7 @@ class SpackEnvs(object):
                 self._create_jinja_environment(
                     python_package_list
                 ).render(customisation),
-                Loader=yaml.FullLoader)
+                Loader=SafeLoader)
             
             if python_activated[ver] is None:
                 python_activated[ver] = [] 
@@ -647,13 +969,23 @@ class SpackEnvs(object):
                 'List of packages to activate for python {}: {}'.format(
                     ver, python_activated[ver]))
 
+        self._python_activated_cache[env] = python_activated
+        return python_activated
+
+    def spack_list_python(self, env, stack_type=None, installed_only=False):
+        customisation = self._get_env_customisation(env)
+        specs = []
+        python_activated = self._python_activated(env, customisation)
+
+        # spack is only asked once per python spec and for the host arch
+        installed_dependents = {}
+        spack_arch = None
+
         if stack_type is not None:
             stack_types = [stack_type]
         else:
             stack_types = customisation['environment']['stack_types']
 
-        installed_pkg_re = re.compile('[0-9a-z]* (.*?)@.*')
-
         for stack_type_ in stack_types:
             for compiler in customisation['environment'][stack_type_]:
                 stack = customisation['environment'][stack_type_][compiler]
@@ -665,6 +997,10 @@ class SpackEnvs(object):
                         stack))
 
                 for ver in [2, 3]:
+                    # no template or nothing to activate for this version
+                    if not python_activated.get(ver):
+                        continue
+
                     spec = {
                         'python_version': customisation['environment']['python'][ver],
                         'python_variants': customisation['environment']['python']['variant'][ver],
@@ -678,17 +1014,17 @@ class SpackEnvs(object):
                         if 'arch' in stack:
                             arch = stack['arch']
                         else:
-                            stdout, stderr, comm = self._run_spack(
-                                'arch'.format(**spec),
-                                environment=env)
-                            spec['arch'] = ' arch={}'.format(
-                                stdout[0].decode('ascii').strip())
+                            if spack_arch is None:
+                                stdout, stderr, comm = self._run_spack(
+                                    'arch', environment=env)
+                                spack_arch = stdout[0].strip()
+                            spec['arch'] = ' arch={}'.format(spack_arch)
 
                     if  arch is not None:
                         spec['arch'] = ' arch=linux-{}-{}'.format(
-                            re.sub('([a-z]+[0-9]+)(\.[0-9]+)+',
-                                   '\\1',
-                                   customisation['environment']['os']),
+                            _OS_VERSION_RE.sub(
+                                r'\1',
+                                customisation['environment']['os']),
                             arch)
 
                     python_spec = 'python@{python_version} {python_variants} %{compiler}{arch}'.format(**spec)
@@ -697,16 +1033,19 @@ class SpackEnvs(object):
                             python_spec))
 
                     list_installed = []
-                    if installed_only:
+                    if installed_only and python_spec in installed_dependents:
+                        list_installed = installed_dependents[python_spec]
+                    elif installed_only:
                         stdout, stderr, comm = self._run_spack(
                             'dependents', '--installed',
                             python_spec,
                             environment=env)
 
                         for line in stdout:
-                            match = installed_pkg_re.match(line.decode('ascii'))
+                            match = _INSTALLED_PKG_RE.match(line)
                             if match:
                                 list_installed.append(match.group(1))
+                        installed_dependents[python_spec] = list_installed
 
                     for package in python_activated[ver]:
                         if installed_only and package not in list_installed:
@@ -736,31 +1075,42 @@ class SpackEnvs(object):
 
             stdout, stderr, comm = self._run_spack('activate', spec, environment=environment)
             for line in stdout:
-                print(' + {}'.format(line.decode('ascii')))
+                print(' + {}'.format(line))
 
             if comm.returncode is None:
                 spack_.wait()
 
             if comm.returncode == 0:
                 print(" = Adding {} to cache".format(spec))
-                cache.cache.append(spec)
+                cache.append(spec)
         cache.save()
 
     def get_environment_entry(self, environment, entry):
         path = entry.split('.')
-        customisation = self._get_env_customisation(environment)
-        node = customisation
-        for level in range(len(path) - 1):
-            node = node[path[level]]
-
-        if path[-1] in node:
-            result = node[path[-1]]
-            if not isinstance(result, str):
-                print(yaml.dump(result))
-            else:
-                print(result)
+        self._check_environment(environment)
+
+        # most entries come straight from the configuration, only resolve
+        # the full customisation (which may call spack) if needed, that is
+        # for missing entries and for subtrees that may hold resolved ones
+        customisation = dict(self.customisation)
+        customisation['environment'] = self._get_env_shallow(environment)
+        try:
+            result = reduce(getitem, path, customisation)
+        except (KeyError, TypeError):
+            result = None
+
+        if result is None or isinstance(result, (dict, list)):
+            customisation = self._get_env_customisation(environment)
+            try:
+                result = reduce(getitem, path, customisation)
+            except (KeyError, TypeError):
+                print('{0} was not specified in configuration'.format(entry))
+                return
+
+        if not isinstance(result, str):
+            print(yaml.dump(result, Dumper=SafeDumper))
         else:
-            print('{0} was not specified in configuration'.format(entry))
+            print(result)
 
 
     def _compiler_component(self, value, component,
@@ -838,8 +1188,8 @@ class SpackEnvs(object):
             core_compiler_prefix = self._spack_path(stack['core_compiler'])
             cc_libdir = os.path.join(core_compiler_prefix, 'lib64')
 
-            core_compiler = _regex_replace(
-                _filter_variant(stack['core_compiler']), '[@+~^][.0-9]*', '')
+            core_compiler = _SPEC_VERSION_RE.sub(
+                '', _filter_variant(stack['core_compiler']))
             if component in ['f77', 'f90']:
                 return self._compiler_component(core_compiler, component,
                                            environment,
@@ -885,19 +1235,16 @@ class SpackEnvs(object):
 def senv(ctxt, input, prefix, debug, override):
     """This command helps with common tasks needed in the SCITAS-EPFL
     continuous integration pipeline"""
-    ctxt.input = input
-    ctxt.override = json.loads(override)
-    ctxt.configuration = yaml.load(input, Loader=yaml.FullLoader)
-    ctxt.prefix = prefix
     if debug:
         logger.setLevel(logging.DEBUG)
+    ctxt.obj = SpackEnvs(yaml.load(input, Loader=SafeLoader),
+                         prefix=prefix,
+                         override=json.loads(override))
     
 @senv.command()
 @click.pass_context
 def status(ctxt):
-    spack_envs = SpackEnvs(ctxt.parent.configuration,
-                           prefix=ctxt.parent.prefix,
-                           override=ctxt.parent.override)
+    spack_envs = ctxt.obj
     spack_envs.status();
 
 @senv.command()
@@ -905,9 +1252,7 @@ def status(ctxt):
 @click.option('--all', default=False, is_flag=True)
 @click.pass_context
 def list_envs(ctxt, cloud, all):
-    spack_envs = SpackEnvs(ctxt.parent.configuration,
-                           prefix=ctxt.parent.prefix,
-                           override=ctxt.parent.override)
+    spack_envs = ctxt.obj
     for env in spack_envs.list_envs(cloud=cloud, all=all):
         print('{}'.format(env))
 
@@ -919,9 +1264,7 @@ def list_envs(ctxt, cloud, all):
 @click.option('--all', default=False, is_flag=True)
 @click.pass_context
 def list_compilers(ctxt, env, stack_type, all):
-    spack_envs = SpackEnvs(ctxt.parent.configuration,
-                           prefix=ctxt.parent.prefix,
-                           override=ctxt.parent.override)
+    spack_envs = ctxt.obj
     compilers = spack_envs.compilers(env, stack_type, all)
     for compiler in compilers:
         print('{}'.format(compiler))
@@ -933,9 +1276,7 @@ def list_compilers(ctxt, env, stack_type, all):
               is_flag=True)
 @click.pass_context
 def create_env(ctxt, env, bootstrap):
-    spack_envs = SpackEnvs(ctxt.parent.configuration,
-                           prefix=ctxt.parent.prefix,
-                           override=ctxt.parent.override)
+    spack_envs = ctxt.obj
     spack_envs.write_env(env, bootstrap=bootstrap)
 
 @senv.command()
@@ -944,74 +1285,64 @@ def create_env(ctxt, env, bootstrap):
               is_flag=True)
 @click.pass_context
 def create_envs(ctxt, bootstrap):
-    spack_envs = SpackEnvs(ctxt.parent.configuration,
-                           prefix=ctxt.parent.prefix,
-                           override=ctxt.parent.override)
+    spack_envs = ctxt.obj
     spack_envs.write_envs(bootstrap=bootstrap)
 
 @senv.command()
 @click.pass_context
 def spack_release(ctxt):
-    spack_envs = SpackEnvs(ctxt.parent.configuration,
-                           prefix=ctxt.parent.prefix,
-                           override=ctxt.parent.override)
+    spack_envs = ctxt.obj
     spack_envs.spack_release()
 
 @senv.command()
 @click.pass_context
 def spack_checkout_dir(ctxt):
-    spack_envs = SpackEnvs(ctxt.parent.configuration,
-                           prefix=ctxt.parent.prefix,
-                           override=ctxt.parent.override)
+    spack_envs = ctxt.obj
     spack_envs.spack_checkout_dir()
 
 @senv.command()
 @click.pass_context
 def spack_external_dir(ctxt):
-    spack_envs = SpackEnvs(ctxt.parent.configuration,
-                           prefix=ctxt.parent.prefix,
-                           override=ctxt.parent.override)
+    spack_envs = ctxt.obj
     spack_envs.spack_external_dir()
 
 @senv.command()
 @click.pass_context
 def list_extra_repositories(ctxt):
-    spack_envs = SpackEnvs(ctxt.parent.configuration,
-                           prefix=ctxt.parent.prefix,
-                           override=ctxt.parent.override)
+    spack_envs = ctxt.obj
     spack_envs.list_extra_repositories()
 
 @senv.command()
 @click.pass_context
 def install_spack_default_configuration(ctxt):
-    spack_envs = SpackEnvs(ctxt.parent.configuration,
-                           prefix=ctxt.parent.prefix,
-                           override=ctxt.parent.override)
+    spack_envs = ctxt.obj
     spack_envs.install_spack_default_configuration()
 
+@senv.command()
+@click.option('--target', default=PRECOMPILED_TEMPLATES,
+              help='Zip file in which to store the compiled templates')
+@click.pass_context
+def compile_templates(ctxt, target):
+    spack_envs = ctxt.obj
+    spack_envs.compile_templates(target)
+
 @senv.command()
 @click.option('--env', help='Environment to list the compiler for')
 @click.pass_context
 def intel_compilers_configuration(ctxt, env):
-    spack_envs = SpackEnvs(ctxt.parent.configuration,
-                           prefix=ctxt.parent.prefix,
-                           override=ctxt.parent.override)
+    spack_envs = ctxt.obj
     spack_envs.intel_compilers_configuration(env)
 
 @senv.command()
 @click.pass_context
 def spack_checkout(ctxt):
-    spack_envs = SpackEnvs(ctxt.parent.configuration,
-                           prefix=ctxt.parent.prefix,
-                           override=ctxt.parent.override)
+    spack_envs = ctxt.obj
     spack_envs.spack_checkout()
 
 @senv.command()
 @click.pass_context
 def spack_checkout_extra_repos(ctxt):
-    spack_envs = SpackEnvs(ctxt.parent.configuration,
-                           prefix=ctxt.parent.prefix,
-                           override=ctxt.parent.override)
+    spack_envs = ctxt.obj
     spack_envs.spack_checkout_extra_repos()
 
 @senv.command()
@@ -1020,9 +1351,7 @@ def spack_checkout_extra_repos(ctxt):
               default=None, required=False)
 @click.pass_context
 def list_spec_to_activate(ctxt, env, stack_type):
-    spack_envs = SpackEnvs(ctxt.parent.configuration,
-                           prefix=ctxt.parent.prefix,
-                           override=ctxt.parent.override)
+    spack_envs = ctxt.obj
     specs = spack_envs.spack_list_python(env, stack_type, installed_only=True)
     for spec in specs:
         print(spec)
@@ -1034,9 +1363,7 @@ def list_spec_to_activate(ctxt, env, stack_type):
               default=None, required=False)
 @click.pass_context
 def activate_specs(ctxt, env, stack_type):
-    spack_envs = SpackEnvs(ctxt.parent.configuration,
-                           prefix=ctxt.parent.prefix,
-                           override=ctxt.parent.override)
+    spack_envs = ctxt.obj
     spack_envs.activate_specs(env, stack_type)
 
 @senv.command()
@@ -1045,7 +1372,5 @@ def activate_specs(ctxt, env, stack_type):
               default=None)
 @click.pass_context
 def get_environment_entry(ctxt, entry, env):
-    spack_envs = SpackEnvs(ctxt.parent.configuration,
-                           prefix=ctxt.parent.prefix,
-                           override=ctxt.parent.override)
+    spack_envs = ctxt.obj
     spack_envs.get_environment_entry(env, entry)
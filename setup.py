@@ -4,11 +4,11 @@ setup(
     name='SCITAS Environment',
     version='0.2',
     py_modules=['senv'],
+    python_requires='>=3.7',
     install_requires=[
         'Click',
         'PyYAML',
         'Jinja2',
-        'GitPython',
     ],
     entry_points='''
         [console_scripts]